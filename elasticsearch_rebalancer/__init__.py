@@ -1,21 +1,31 @@
 from collections import deque
-from time import sleep
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep, time
 
 import click
 import requests
 
 
 from .util import (
+    SHARD_COLUMNS,
+    build_state,
     check_cluster_health,
-    combine_nodes_and_shards,
     execute_reroute_commands,
     format_shard_size,
+    get_max_node,
+    get_min_node,
+    get_node_disk_percents,
+    get_node_shards,
     get_nodes,
     get_shard_size,
     get_shards,
-    get_transient_cluster_settings,
+    get_transient_and_persistent_cluster_settings,
+    parse_time_value,
     set_transient_cluster_settings,
+    summarize_nodes,
+    update_state,
     wait_for_no_relocations,
+    wait_for_relocations_below,
 )
 
 
@@ -25,135 +35,240 @@ class BalanceException(click.ClickException):
         super(BalanceException, self).__init__(message)
 
 
-def find_node(nodes, node_name=None):
-    if not isinstance(nodes, list):
-        nodes = list(nodes)
+def find_node(name_to_node, node_name):
+    try:
+        return name_to_node[node_name]
+    except KeyError:
+        raise ValueError(f'Could not find node: {node_name}')
+
+
+def find_shard(state, shards, to_node_name, biggest=False):
+    # Find the position of the smallest (or biggest) shard that can be moved to
+    # the target node, ie the node doesn't have a shard of the same index and no
+    # other copy of the shard has already been moved.
+    positions = range(len(shards) - 1, -1, -1) if biggest else range(len(shards))
+
+    for position in positions:
+        shard = shards[position]
+        if (
+            to_node_name not in state.index_to_node_names[shard['index']]
+            and shard['id'] not in state.moved_shard_ids
+        ):
+            return position
 
-    if not node_name:
-        return nodes[0]
 
-    for node in nodes:
-        if node['name'] == node_name:
-            return node
+def find_swap_chain(state, max_node, min_node, one_way=False):
+    # Find the best chain of moves max -> mid -> min (-> max unless one way) via
+    # an intermediate node, for when there's no direct swap between max & min.
+    # Returns (mid_node, max/mid/min shard positions) or None.
+    index_to_node_names = state.index_to_node_names
+    moved_shard_ids = state.moved_shard_ids
 
-    raise ValueError(f'Could not find node: {node_name}')
+    max_node_shards = get_node_shards(state, max_node['name'])
+    min_node_shards = get_node_shards(state, min_node['name'])
+
+    min_shard_position = None
+    min_shard_weight = 0
+
+    if not one_way:
+        min_shard_position = find_shard(state, min_node_shards, max_node['name'])
+        if min_shard_position is None:
+            return
+        min_shard_weight = min_node_shards[min_shard_position]['weight']
+
+    min_node_name = min_node['name']
+    best_spread = max_node['weight'] - min_node['weight']
+    best_chain = None
+
+    for mid_node in state.name_to_node.values():
+        if mid_node is max_node or mid_node is min_node:
+            continue
+
+        max_shard_position = find_shard(
+            state, max_node_shards, mid_node['name'],
+            biggest=True,
+        )
+        if max_shard_position is None:
+            continue
+        max_shard_weight = max_node_shards[max_shard_position]['weight']
+
+        # Only the mid -> min shard varies below, so work out the weights each
+        # node ends up with apart from that shard up front.
+        max_weight = max_node['weight'] - max_shard_weight + min_shard_weight
+        mid_weight = mid_node['weight'] + max_shard_weight
+        min_weight = min_node['weight'] - min_shard_weight
+
+        mid_node_shards = get_node_shards(state, mid_node['name'])
+
+        for mid_shard_position, shard in enumerate(mid_node_shards):
+            if (
+                min_node_name in index_to_node_names[shard['index']]
+                or shard['id'] in moved_shard_ids
+            ):
+                continue
+
+            shard_weight = shard['weight']
+            weights = (
+                max_weight,
+                mid_weight - shard_weight,
+                min_weight + shard_weight,
+            )
+            spread = max(weights) - min(weights)
+
+            if spread < best_spread:
+                best_spread = spread
+                best_chain = (
+                    mid_node,
+                    max_shard_position, mid_shard_position, min_shard_position,
+                )
+
+    return best_chain
 
 
 def attempt_to_find_swap(
-    nodes, shards, used_shards,
+    state, messages,
     max_node_name=None,
     min_node_name=None,
     format_shard_weight_function=lambda weight: weight,
     one_way=False,
+    depth=1,
+    threshold_percent=1.0,
 ):
-    ordered_nodes, node_name_to_shards, index_to_node_names = (
-        combine_nodes_and_shards(nodes, shards)
+    min_node = (
+        find_node(state.name_to_node, min_node_name)
+        if min_node_name else get_min_node(state)
+    )
+    max_node = (
+        find_node(state.name_to_node, max_node_name)
+        if max_node_name else get_max_node(state)
     )
-
-    min_node = find_node(ordered_nodes, min_node_name)
-    max_node = find_node(reversed(ordered_nodes), max_node_name)
 
     min_weight = min_node['weight']
     max_weight = max_node['weight']
-    spread_used = round(max_weight - min_weight, 2)
+    min_shard_count = min_node['shard_count']
+    max_shard_count = max_node['shard_count']
+    spread_used = max_weight - min_weight
 
-    click.echo((
-        f'> Weight used over {len(nodes)} nodes: '
+    messages.append((
+        f'> Weight used over {len(state.nodes)} nodes: '
         f'min={format_shard_weight_function(min_weight)}, '
         f'max={format_shard_weight_function(max_weight)}, '
         f'spread={format_shard_weight_function(spread_used)}'
     ))
 
-    max_node_shards = node_name_to_shards[max_node['name']]
-    min_node_shards = node_name_to_shards[min_node['name']]
+    # Any further swaps would move data around for a negligible improvement. Not
+    # applied to forced nodes, which may be (or are deliberately) imbalanced.
+    if (
+        not max_node_name and not min_node_name
+        and spread_used <= max_weight * threshold_percent / 100
+    ):
+        messages.append(
+            f'> Cluster is balanced (spread within {threshold_percent}% of max)!',
+        )
+        return []
 
-    for shard in reversed(max_node_shards):  # biggest to smallest shard
-        if (
-            shard['id'] not in used_shards
-            and min_node['name'] not in index_to_node_names[shard['index']]
-        ):
-            max_shard = shard
-            break
-    else:
-        raise BalanceException((
-            'Could not find suitable large shard to move to '
-            f'{min_node["name"]}!'
-        ))
+    max_node_shards = get_node_shards(state, max_node['name'])
+    min_node_shards = get_node_shards(state, min_node['name'])
 
-    for shard in min_node_shards:
-        if (
-            shard['id'] not in used_shards
-            and max_node['name'] not in index_to_node_names[shard['index']]
-        ):
-            min_shard = shard
-            break
-    else:
-        raise BalanceException((
-            'Could not find suitable small shard to move to '
-            f'{max_node["name"]}!'
-        ))
+    max_shard_position = find_shard(
+        state, max_node_shards, min_node['name'],
+        biggest=True,
+    )
+    min_shard_position = find_shard(state, min_node_shards, max_node['name'])
+
+    error = None
+    if max_shard_position is None:
+        error = f'Could not find suitable large shard to move to {min_node["name"]}!'
+    elif min_shard_position is None:
+        error = f'Could not find suitable small shard to move to {max_node["name"]}!'
+    elif not one_way:
+        swap_weight = (
+            max_node_shards[max_shard_position]['weight']
+            - min_node_shards[min_shard_position]['weight']
+        )
+        if min_weight + swap_weight >= max_weight - swap_weight:
+            error = 'Cannot optimise shards any further!'
 
-    # Update shard + node info according to the reroutes
-    used_shards.add(max_shard['id'])
-    max_shard['node'] = min_node['name']
-    min_node['weight'] += max_shard['weight']
-    max_node['weight'] -= max_shard['weight']
+    mid_node = None
 
-    if not one_way:
-        used_shards.add(min_shard['id'])
-        min_shard['node'] = max_node['name']
-        min_node['weight'] -= min_shard['weight']
-        max_node['weight'] += min_shard['weight']
+    # Moved shards are removed from the candidate lists so they are not used again
+    if not error:
+        moves = [(max_node_shards.pop(max_shard_position), max_node, min_node)]
+        if not one_way:
+            moves.append((min_node_shards.pop(min_shard_position), min_node, max_node))
+    else:
+        chain = None
+        if depth > 1:
+            chain = find_swap_chain(state, max_node, min_node, one_way=one_way)
+        if not chain:
+            raise BalanceException(error)
+
+        mid_node, max_shard_position, mid_shard_position, min_shard_position = chain
+        mid_weight = mid_node['weight']
+        mid_shard_count = mid_node['shard_count']
+
+        moves = [
+            (max_node_shards.pop(max_shard_position), max_node, mid_node),
+            (
+                get_node_shards(state, mid_node['name']).pop(mid_shard_position),
+                mid_node, min_node,
+            ),
+        ]
+        if not one_way:
+            moves.append((min_node_shards.pop(min_shard_position), min_node, max_node))
 
-        if min_node['weight'] >= max_node['weight']:
-            raise BalanceException('Cannot optimise shards any further!')
+    # Update shard + node info according to the reroutes
+    update_state(state, moves)
 
-    if one_way:
-        click.echo((
+    if mid_node:
+        messages.append('> Recommended chain for: ' + ', '.join(
+            f'{shard["id"]} ({format_shard_weight_function(shard["weight"])}) '
+            f'-> {to_node["name"]}'
+            for shard, _, to_node in moves
+        ))
+    elif one_way:
+        max_shard, _, _ = moves[0]
+        messages.append((
             '> Recommended move for: '
             f'{max_shard["id"]} ({format_shard_weight_function(max_shard["weight"])})'
         ))
     else:
-        click.echo((
+        (max_shard, _, _), (min_shard, _, _) = moves
+        messages.append((
             '> Recommended swap for: '
             f'{max_shard["id"]} ({format_shard_weight_function(max_shard["weight"])}) <> '
             f'{min_shard["id"]} ({format_shard_weight_function(min_shard["weight"])})'
         ))
 
-    click.echo((
-        f'  maxNode: {max_node["name"]} ({len(max_node_shards)} shards) '
+    messages.append((
+        f'  maxNode: {max_node["name"]} ({max_shard_count} shards) '
         f'({format_shard_weight_function(max_weight)} '
         f'-> {format_shard_weight_function(max_node["weight"])})'
     ))
-    click.echo((
-        f'  minNode: {min_node["name"]} ({len(min_node_shards)} shards) '
+    if mid_node:
+        messages.append((
+            f'  midNode: {mid_node["name"]} ({mid_shard_count} shards) '
+            f'({format_shard_weight_function(mid_weight)} '
+            f'-> {format_shard_weight_function(mid_node["weight"])})'
+        ))
+    messages.append((
+        f'  minNode: {min_node["name"]} ({min_shard_count} shards) '
         f'({format_shard_weight_function(min_weight)} '
         f'-> {format_shard_weight_function(min_node["weight"])})'
     ))
 
-    reroute_commands = [
+    return [
         {
             'move': {
-                'index': max_shard['index'],
-                'shard': max_shard['shard'],
-                'from_node': max_node['name'],
-                'to_node': min_node['name'],
+                'index': shard['index'],
+                'shard': shard['shard'],
+                'from_node': from_node['name'],
+                'to_node': to_node['name'],
             },
-        },
+        }
+        for shard, from_node, to_node in moves
     ]
 
-    if not one_way:
-        reroute_commands.append({
-            'move': {
-                'index': min_shard['index'],
-                'shard': min_shard['shard'],
-                'from_node': min_node['name'],
-                'to_node': max_node['name'],
-            },
-        })
-
-    return reroute_commands
-
 
 def print_command(command):
     args = command['move']
@@ -163,15 +278,145 @@ def print_command(command):
     ))
 
 
-def check_raise_health(es_host):
+def check_raise_health(es_host, max_relocating_shards=0):
     # Check we're good to go
     try:
-        check_cluster_health(es_host)
+        check_cluster_health(es_host, max_relocating_shards=max_relocating_shards)
     except Exception as e:
         raise BalanceException(f'{e}')
 
 
-def print_execute_reroutes(es_host, commands):
+def check_reroute_allowed(es_host, commands):
+    try:
+        execute_reroute_commands(es_host, commands, dry_run=True)
+    except requests.HTTPError as e:
+        if e.response.status_code != 400:
+            raise
+        return False
+    return True
+
+
+def wait_for_reroute_allowed(es_host, commands, timeout):
+    # Poll with dry runs until ES would accept the reroutes - each one runs the
+    # allocation deciders on the master, so don't go much faster than 1/s.
+    deadline = time() + timeout
+
+    while time() < deadline:
+        sleep(1)
+        if check_reroute_allowed(es_host, commands):
+            return True
+    return False
+
+
+def get_nodes_over_watermark(es_host, commands, watermark):
+    # Watermarks can be a percentage or ratio of disk used, or an absolute amount
+    # of free space which isn't handled here.
+    try:
+        if watermark.endswith('%'):
+            max_disk_percent = float(watermark[:-1])
+        else:
+            max_disk_percent = float(watermark) * 100
+    except ValueError:
+        return []
+
+    node_disk_percents = get_node_disk_percents(es_host)
+    node_names = {command['move']['to_node'] for command in commands}
+
+    return sorted(
+        node_name for node_name in node_names
+        if node_disk_percents.get(node_name, 0) >= max_disk_percent
+    )
+
+
+def print_execute_reroute_chunks(
+    es_host, commands, batch_size, cluster_update_interval,
+    low_watermark='85%',
+    concurrent_rebalance=2,
+):
+    chunks = deque(
+        commands[i:i + batch_size]
+        for i in range(0, len(commands), batch_size)
+    )
+
+    while chunks:
+        chunk = chunks.popleft()
+
+        try:
+            execute_reroute_commands(es_host, chunk)
+        except requests.HTTPError as e:
+            if e.response.status_code != 400 or len(chunk) == 1:
+                raise
+            click.echo(e)
+            # Split the rejected chunk in half and try again, down to a single
+            # reroute per request.
+            half = len(chunk) // 2
+            chunks.extendleft((chunk[half:], chunk[:half]))
+            continue
+
+        for command in chunk:
+            print_command(command)
+
+        if not chunks:
+            break
+
+        # Rather than waiting for every relocation to finish keep up to the ES
+        # concurrent rebalance limit in flight, so the next chunk starts as soon
+        # as there is room for it.
+        click.echo(
+            f'Waiting for fewer than {concurrent_rebalance} relocation(s)...',
+        )
+        wait_for_relocations_below(es_host, concurrent_rebalance)
+        # Check the cluster is still good
+        check_raise_health(
+            es_host,
+            max_relocating_shards=max(concurrent_rebalance - 1, 0),
+        )
+
+        # Only pipeline the next chunk if ES would accept it right away
+        if check_reroute_allowed(es_host, chunks[0]):
+            continue
+
+        # Otherwise it likely needs the space freed by the in-flight relocations
+        click.echo('Waiting for relocations to complete...')
+        wait_for_no_relocations(es_host)
+        check_raise_health(es_host)  # check the cluster is still good
+
+        # ES might still think there's not enough space for the next reroute
+        # until the next cluster info update - so dry run it again and only wait
+        # if it would be rejected.
+        if check_reroute_allowed(es_host, chunks[0]):
+            continue
+
+        # If the nodes are actually over the watermark (according to current disk
+        # usage, not the cluster info) waiting for an update won't help, so just
+        # go ahead and let ES reject/split the reroutes.
+        full_node_names = get_nodes_over_watermark(es_host, chunks[0], low_watermark)
+        if full_node_names:
+            click.echo(click.style(
+                f'Nodes over the low disk watermark: {", ".join(full_node_names)}',
+                'yellow',
+            ))
+            continue
+
+        # Wait until ES picks up the new disk usage & accepts the reroute, this
+        # should take no longer than the minimum update interval.
+        wait_for_reroute_allowed(
+            es_host, chunks[0],
+            timeout=cluster_update_interval + 5,
+        )
+
+    click.echo('Waiting for relocations to complete...')
+    wait_for_no_relocations(es_host)
+    check_raise_health(es_host)
+
+
+def print_execute_reroutes(
+    es_host, commands,
+    cluster_update_interval=30,
+    low_watermark='85%',
+    batch_size=None,
+    concurrent_rebalance=2,
+):
     try:
         execute_reroute_commands(es_host, commands)
     except requests.HTTPError as e:
@@ -187,56 +432,47 @@ def print_execute_reroutes(es_host, commands):
         wait_for_no_relocations(es_host)
         return
 
-    # Now try to execute the reroutes one by one - it's likely that ES rejected the
-    # parallel re-route because it would push the max node over the disk threshold.
-    # So now attempt to reroute one shard at a time - first the big shard off the
-    # big node, which should make space for the returning shard.
+    # Now try to execute the reroutes in smaller batches - it's likely that ES
+    # rejected the parallel re-route because it would push the max node over the
+    # disk threshold. So now attempt to reroute a few shards at a time - the big
+    # shard off the big node goes first, which should make space for the
+    # returning shard.
     if not click.confirm(click.style(
-        'Parallel rerouting failed! Attempt shard by shard?',
+        'Parallel rerouting failed! Attempt in smaller batches?',
         'yellow',
     )):
         raise BalanceException('User exited serial rerouting!')
 
-    cluster_update_interval = get_transient_cluster_settings(
-        es_host, 'cluster.info.update.interval',
-    )['cluster.info.update.interval'] or '30s'
-
-    cluster_update_interval = int(cluster_update_interval[:-1])
-
-    for i, command in enumerate(commands, 1):
-        print_command(command)
-        execute_reroute_commands(es_host, [command])
+    # By default split the commands in half, any rejected half is split again
+    if not batch_size:
+        batch_size = max(len(commands) // 2, 1)
 
-        click.echo(
-            f'Waiting for relocation to complete ({i}/{len(commands)})...',
-        )
-        wait_for_no_relocations(es_host)
-        check_raise_health(es_host)  # check the cluster is still good
-        # Wait for minimum update interval or ES might still think there's not
-        # enough space for the next reroute.
-        sleep(cluster_update_interval + 1)
+    print_execute_reroute_chunks(
+        es_host, commands,
+        batch_size=batch_size,
+        cluster_update_interval=cluster_update_interval,
+        low_watermark=low_watermark,
+        concurrent_rebalance=concurrent_rebalance,
+    )
 
 
 def print_node_shard_states(
     nodes, shards,
     format_shard_weight_function=format_shard_size,
 ):
-    ordered_nodes, node_name_to_shards, _ = (
-        combine_nodes_and_shards(nodes, shards)
-    )
-
-    for node in ordered_nodes:
+    for node in summarize_nodes(nodes, shards):
         click.echo(
-            f'> Node: {node["name"]}, '
-            f'shards: {len(node_name_to_shards[node["name"]])}, '
-            f'weight: {format_shard_weight_function(node["weight"])}'
-            f' ({node["weight_percentage"]})%',
+            f'> Node: {node.name}, '
+            f'shards: {node.shard_count}, '
+            f'weight: {format_shard_weight_function(node.weight)}'
+            f' ({node.weight_percentage})%',
         )
 
 
 def make_rebalance_elasticsearch_cli(
     get_shard_weight_function=get_shard_size,
     format_shard_weight_function=format_shard_size,
+    shard_columns=SHARD_COLUMNS,
 ):
     @click.command()
     @click.argument('es_host')
@@ -298,6 +534,34 @@ def make_rebalance_elasticsearch_cli(
             'shards even when the most full nodes are on the limit.'
         ),
     )
+    @click.option(
+        '--depth',
+        default=1,
+        type=click.IntRange(min=1, max=2),
+        help=(
+            'Max depth of moves to search, 2 also considers chains of moves via '
+            'a third node when no direct swap between max & min is possible.'
+        ),
+    )
+    @click.option(
+        '--batch-size',
+        default=None,
+        type=click.IntRange(min=1),
+        help=(
+            'Number of reroutes to execute at once if the parallel reroute '
+            'fails (default half of them), halved on any rejected batch.'
+        ),
+    )
+    @click.option(
+        '--threshold-percent',
+        default=1.0,
+        type=click.FloatRange(min=0),
+        help=(
+            'Stop swapping once the weight spread between the min & max nodes '
+            'is within this percentage of the max node weight. Ignored when '
+            '--max-node or --min-node are given.'
+        ),
+    )
     def rebalance_elasticsearch(
         es_host,
         iterations=1,
@@ -309,6 +573,9 @@ def make_rebalance_elasticsearch_cli(
         min_node=None,
         one_way=False,
         override_watermarks=None,
+        depth=1,
+        batch_size=None,
+        threshold_percent=1.0,
     ):
         # Parse out any attrs
         attrs = {}
@@ -348,26 +615,66 @@ def make_rebalance_elasticsearch_cli(
                     'cluster.routing.allocation.disk.watermark.high': override_watermarks,
                 })
 
-            # Save the old value to restore later
-            previous_settings = get_transient_cluster_settings(es_host, settings_to_set.keys())
+            # Save the old (transient) values to restore later, reading the settings
+            # needed if we fall back to serial rerouting in the same request.
+            transient_settings, persistent_settings = (
+                get_transient_and_persistent_cluster_settings(es_host, [
+                    *settings_to_set.keys(),
+                    'cluster.info.update.interval',
+                    'cluster.routing.allocation.disk.watermark.low',
+                    'cluster.routing.allocation.cluster_concurrent_rebalance',
+                ])
+            )
+            previous_settings = {
+                key: transient_settings[key]
+                for key in settings_to_set
+            }
+            # Transient settings take precedence over persistent ones
+            current_settings = {
+                key: (
+                    value if value is not None
+                    else persistent_settings[key]
+                )
+                for key, value in transient_settings.items()
+            }
+            try:
+                cluster_update_interval = parse_time_value(
+                    current_settings['cluster.info.update.interval'] or '30s',
+                )
+            except ValueError as e:
+                click.echo(click.style(f'{e}, assuming 30s update interval', 'yellow'))
+                cluster_update_interval = 30
+            low_watermark = (
+                settings_to_set.get('cluster.routing.allocation.disk.watermark.low')
+                or current_settings['cluster.routing.allocation.disk.watermark.low']
+                or '85%'
+            )
+            concurrent_rebalance = int(current_settings[
+                'cluster.routing.allocation.cluster_concurrent_rebalance'
+            ] or 2)
             set_transient_cluster_settings(es_host, settings_to_set)
 
         try:
-            click.echo('Loading nodes...')
-            nodes = get_nodes(es_host, attrs=attrs)
+            # Load nodes & shards at the same time, they're independent requests
+            click.echo('Loading nodes & shards...')
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                nodes_future = executor.submit(get_nodes, es_host, attrs=attrs)
+                shards_future = executor.submit(
+                    get_shards,
+                    es_host,
+                    attrs=attrs,
+                    index_name_filter=index_name,
+                    get_shard_weight_function=get_shard_weight_function,
+                    shard_columns=shard_columns,
+                )
+                nodes = nodes_future.result()
+                shards = shards_future.result()
+
             if not nodes:
                 raise BalanceException('No nodes found!')
 
             click.echo(f'> Found {len(nodes)} nodes')
-            click.echo()
 
-            click.echo('Loading shards...')
-            shards = get_shards(
-                es_host,
-                attrs=attrs,
-                index_name_filter=index_name,
-                get_shard_weight_function=get_shard_weight_function,
-            )
             if not shards:
                 raise BalanceException('No shards found!')
 
@@ -385,31 +692,55 @@ def make_rebalance_elasticsearch_cli(
             click.echo('Investigating rebalance options...')
 
             all_reroute_commands = []
-            used_shards = set()
+            # When both ends of the swaps are forced skip every other node, unless
+            # chains of moves may go via any other (mid) node.
+            forced_node_names = None
+            if min_node and max_node and depth == 1:
+                forced_node_names = set(min_node) | set(max_node)
+
+            state = build_state(nodes, shards, node_names=forced_node_names)
+            if not state.name_to_node:
+                raise BalanceException('No nodes with shards found!')
+
+            # Collect the planning output and print it in one go, rather than
+            # interleaving terminal I/O with each iteration.
+            messages = []
+
+            try:
+                for i in range(iterations):
+                    messages.append(f'> Iteration {i}')
+                    reroute_commands = attempt_to_find_swap(
+                        state, messages,
+                        max_node_name=max_node[0] if max_node else None,
+                        min_node_name=min_node[0] if min_node else None,
+                        format_shard_weight_function=format_shard_weight_function,
+                        one_way=one_way,
+                        depth=depth,
+                        threshold_percent=threshold_percent,
+                    )
+                    messages.append('')
+
+                    if not reroute_commands:
+                        break
 
-            for i in range(iterations):
-                click.echo(f'> Iteration {i}')
-                reroute_commands = attempt_to_find_swap(
-                    nodes, shards,
-                    used_shards=used_shards,
-                    max_node_name=max_node[0] if max_node else None,
-                    min_node_name=min_node[0] if min_node else None,
-                    format_shard_weight_function=format_shard_weight_function,
-                    one_way=one_way,
-                )
-
-                if reroute_commands:
                     all_reroute_commands.extend(reroute_commands)
 
-                click.echo()
-
-                if min_node:
-                    min_node.rotate()
-                if max_node:
-                    max_node.rotate()
-
-            if commit:
-                print_execute_reroutes(es_host, all_reroute_commands)
+                    if min_node:
+                        min_node.rotate()
+                    if max_node:
+                        max_node.rotate()
+            finally:
+                if messages:
+                    click.echo('\n'.join(messages))
+
+            if commit and all_reroute_commands:
+                print_execute_reroutes(
+                    es_host, all_reroute_commands,
+                    cluster_update_interval=cluster_update_interval,
+                    low_watermark=low_watermark,
+                    batch_size=batch_size,
+                    concurrent_rebalance=concurrent_rebalance,
+                )
 
         except requests.HTTPError as e:
             click.echo(click.style(e.response.content, 'yellow'))
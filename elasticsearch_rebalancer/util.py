@@ -1,91 +1,146 @@
-from collections import defaultdict
+import heapq
+
+from collections import Counter, defaultdict, namedtuple
 from fnmatch import fnmatch
+from operator import itemgetter
 from time import sleep
 
+import orjson
 import requests
 
-from humanize import naturalsize
+from requests.adapters import HTTPAdapter
+
+
+# Shared session so connections to ES are kept alive & reused between requests
+SESSION = requests.Session()
+SESSION.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=16))
 
 
 def matches_attrs(attrs, match_attrs):
+    if not match_attrs:
+        return True
+
     for key, value in match_attrs.items():
         if attrs.get(key) != value:
             return False
     return True
 
 
-def es_request(es_host, endpoint, method=requests.get, **kwargs):
-    response = method(
+def es_request(es_host, endpoint, method='GET', **kwargs):
+    response = SESSION.request(
+        method,
         f'http://{es_host}/{endpoint}',
         **kwargs,
     )
 
     response.raise_for_status()
-    return response.json()
+    return orjson.loads(response.content)
 
 
-def get_cluster_health(es_host):
-    return es_request(es_host, '_cluster/health')
+def get_cluster_health(es_host, params=None):
+    return es_request(es_host, '_cluster/health', params=params)
 
 
 def get_cluster_settings(es_host):
-    return es_request(es_host, '_cluster/settings')
+    # Flat settings are keyed by the full dotted path ("cluster.info.update.interval")
+    return es_request(es_host, '_cluster/settings', params={
+        'flat_settings': 'true',
+    })
 
 
-def check_cluster_health(es_host):
+def check_cluster_health(es_host, max_relocating_shards=0):
     health = get_cluster_health(es_host)
 
     if health['status'] != 'green':
         raise Exception('ES is not green!')
 
     relocating_shards = health['relocating_shards']
-    if relocating_shards > 0:
+    if relocating_shards > max_relocating_shards:
         raise Exception(f'ES is already relocating {relocating_shards} shards!')
 
 
 def wait_for_no_relocations(es_host):
+    # Have ES hold the request until there are no relocations rather than polling,
+    # re-requesting whenever it times out (which ES responds to with a 408).
     while True:
-        health = get_cluster_health(es_host)
+        try:
+            health = get_cluster_health(es_host, params={
+                'wait_for_no_relocating_shards': 'true',
+                'timeout': '60s',
+            })
+        except requests.HTTPError as e:
+            if e.response.status_code != 408:
+                raise
+            continue
 
-        relocating_shards = health['relocating_shards']
-        if not relocating_shards:
+        if not health['timed_out']:
             break
 
+
+def wait_for_relocations_below(es_host, max_relocating_shards):
+    # ES can only hold the request until there are *no* relocations, so poll
+    # (relocations can take a while, hence the long interval) for the count to
+    # drop below anything higher.
+    if max_relocating_shards <= 1:
+        return wait_for_no_relocations(es_host)
+
+    while get_cluster_health(es_host)['relocating_shards'] >= max_relocating_shards:
         sleep(10)
 
 
-def execute_reroute_commands(es_host, commands):
-    es_request(es_host, '_cluster/reroute', method=requests.post, json={
+def execute_reroute_commands(es_host, commands, dry_run=False):
+    # By default ES responds with (most of) the cluster state, which we ignore
+    params = {'filter_path': 'acknowledged'}
+    if dry_run:
+        params['dry_run'] = 'true'
+
+    es_request(es_host, '_cluster/reroute', method='POST', params=params, json={
         'commands': commands,
     })
 
 
-def get_transient_cluster_settings(es_host, paths):
-    settings = get_cluster_settings(es_host)
-    path_to_value = {}
-
-    for path in paths:
-        attrs = path.split('.')
-
-        value = settings['transient']
-        for attr in attrs:
-            value = value.get(attr)
-            if not value:
-                path_to_value[path] = None
+# ES time units in seconds, longer suffixes first as eg "ms" also ends in "s"
+TIME_UNIT_SECONDS = (
+    ('nanos', 1e-9),
+    ('micros', 1e-6),
+    ('ms', 1e-3),
+    ('s', 1),
+    ('m', 60),
+    ('h', 60 * 60),
+    ('d', 24 * 60 * 60),
+)
+
+
+def parse_time_value(value):
+    # Parse an ES time setting value ("500ms", "30s", "1m") into seconds
+    for unit, seconds in TIME_UNIT_SECONDS:
+        if value.endswith(unit):
+            try:
+                return float(value[:-len(unit)]) * seconds
+            except ValueError:
                 break
-        path_to_value[path] = value
+    raise ValueError(f'Invalid time value: {value}')
+
 
-    return path_to_value
+def get_transient_and_persistent_cluster_settings(es_host, paths):
+    settings = get_cluster_settings(es_host)
+    return tuple(
+        {path: settings[settings_type].get(path) for path in paths}
+        for settings_type in ('transient', 'persistent')
+    )
 
 
 def set_transient_cluster_settings(es_host, path_to_value):
-    es_request(es_host, '_cluster/settings', method=requests.put, json={
+    es_request(es_host, '_cluster/settings', method='PUT', json={
         'transient': path_to_value,
     })
 
 
 def get_nodes(es_host, attrs=None):
-    nodes = es_request(es_host, '_nodes/stats/fs')['nodes']
+    # Only the name & attributes are used, have ES drop the rest of the stats
+    nodes = es_request(es_host, '_nodes/stats/fs', params={
+        'filter_path': 'nodes.*.name,nodes.*.attributes',
+    })['nodes']
     filtered_nodes = []
 
     for node_id, node_data in nodes.items():
@@ -97,23 +152,56 @@ def get_nodes(es_host, attrs=None):
     return filtered_nodes
 
 
+def get_node_disk_percents(es_host):
+    allocations = es_request(
+        es_host, '_cat/allocation',
+        params={
+            'format': 'json',
+            'h': 'node,disk.percent',
+        },
+    )
+
+    # Skip the UNASSIGNED row, which has no disk stats
+    return {
+        allocation['node']: int(allocation['disk.percent'])
+        for allocation in allocations
+        if allocation['disk.percent'] is not None
+    }
+
+
+# Columns requested from _cat/shards, any custom shard weight function must only
+# use these (or pass its own list to get_shards).
+SHARD_COLUMNS = ('index', 'shard', 'prirep', 'state', 'docs', 'store', 'node')
+
+
 def get_shard_size(shard):
     return int(shard['store'])
 
 
+SIZE_UNITS = ('KiB', 'MiB', 'GiB', 'TiB', 'PiB', 'EiB', 'ZiB', 'YiB')
+
+
 def format_shard_size(weight):
-    return naturalsize(weight, binary=True)
+    # Same output as humanize.naturalsize(weight, binary=True) but much cheaper,
+    # this is called several times for every swap.
+    if abs(weight) == 1:
+        return f'{int(weight)} Byte'
 
+    if abs(weight) < 1024:
+        return f'{int(weight)} Bytes'
 
-def get_shards(
-    es_host,
-    attrs=None,
-    index_name_filter=None,
-    get_shard_weight_function=get_shard_size,
-):
-    indices = es_request(es_host, '_settings')
+    for unit in SIZE_UNITS:
+        weight /= 1024
+        # Step up a unit if rounding would give "1024.0 KiB"
+        if abs(weight) < 1023.95 or unit == SIZE_UNITS[-1]:
+            return f'{weight:.1f} {unit}'
+
+
+def get_filtered_index_names(es_host, attrs=None, index_name_filter=None):
+    # Include hidden indices, like _cat/shards does
+    indices = es_request(es_host, '_settings', params={'expand_wildcards': 'all'})
 
-    filtered_index_names = []
+    filtered_index_names = set()
 
     for index_name, index_data in indices.items():
         index_settings = index_data['settings']['index']
@@ -129,13 +217,34 @@ def get_shards(
         if index_name_filter and not fnmatch(index_name, index_name_filter):
             continue
 
-        filtered_index_names.append(index_name)
+        filtered_index_names.add(index_name)
+    return filtered_index_names
+
+
+def get_shards(
+    es_host,
+    attrs=None,
+    index_name_filter=None,
+    get_shard_weight_function=get_shard_size,
+    shard_columns=SHARD_COLUMNS,
+):
+    # Done separately so the (potentially large) index settings response can be
+    # freed before loading the shards. Skipped entirely if there's nothing to
+    # filter the indices by.
+    filtered_index_names = None
+    if attrs or index_name_filter:
+        filtered_index_names = get_filtered_index_names(
+            es_host,
+            attrs=attrs,
+            index_name_filter=index_name_filter,
+        )
 
     shards = es_request(
         es_host, '_cat/shards',
         params={
             'format': 'json',
             'bytes': 'b',
+            'h': ','.join(shard_columns),
         },
     )
 
@@ -144,7 +253,10 @@ def get_shards(
     for shard in shards:
         if (
             shard['state'] != 'STARTED'
-            or shard['index'] not in filtered_index_names
+            or (
+                filtered_index_names is not None
+                and shard['index'] not in filtered_index_names
+            )
         ):
             continue
 
@@ -157,34 +269,181 @@ def get_shards(
 
 def combine_nodes_and_shards(nodes, shards):
     node_name_to_shards = defaultdict(list)
-    index_to_node_names = defaultdict(list)
+    # Index -> counts of shards per node, a node name is only present while the
+    # node holds at least one shard of the index (so `in` is O(1) and exact).
+    index_to_node_names = defaultdict(Counter)
+    node_name_to_weight = Counter()
 
     for shard in shards:
         node_name_to_shards[shard['node']].append(shard)
-        index_to_node_names[shard['index']].append(shard['node'])
+        index_to_node_names[shard['index']][shard['node']] += 1
+        node_name_to_weight[shard['node']] += shard['weight']
 
-    node_name_to_shards = {
-        node_name: sorted(shards, key=lambda shard: shard['weight'])
-        for node_name, shards in node_name_to_shards.items()
-    }
+    node_name_to_shards = dict(node_name_to_shards)
 
     ordered_nodes = []
     for node in nodes:
         if node['name'] not in node_name_to_shards:
             continue
 
-        node['weight'] = sum(
-            shard['weight'] for shard in node_name_to_shards[node['name']]
-        )
+        node['weight'] = node_name_to_weight[node['name']]
+        node['shard_count'] = len(node_name_to_shards[node['name']])
 
         ordered_nodes.append(node)
 
     ordered_nodes = sorted(ordered_nodes, key=lambda node: node['weight'])
 
-    # min_weight = ordered_nodes[0]['weight']
-    max_weight = ordered_nodes[-1]['weight']
+    name_to_node = {node['name']: node for node in ordered_nodes}
+
+    return ordered_nodes, name_to_node, node_name_to_shards, index_to_node_names
+
+
+NodeSummary = namedtuple('NodeSummary', (
+    'name',
+    'shard_count',
+    'weight',
+    'weight_percentage',
+))
+
+
+def summarize_nodes(nodes, shards):
+    # Cheaper version of combine_nodes_and_shards for just printing node states
+    node_name_to_shard_count = Counter()
+    node_name_to_weight = Counter()
+
+    for shard in shards:
+        node_name_to_shard_count[shard['node']] += 1
+        node_name_to_weight[shard['node']] += shard['weight']
+
+    ordered_node_names = sorted(
+        (
+            node['name'] for node in nodes
+            if node['name'] in node_name_to_shard_count
+        ),
+        key=lambda node_name: node_name_to_weight[node_name],
+    )
+
+    if not ordered_node_names:
+        return []
+
+    max_weight = node_name_to_weight[ordered_node_names[-1]]
+
+    return [
+        NodeSummary(
+            name=node_name,
+            shard_count=node_name_to_shard_count[node_name],
+            weight=node_name_to_weight[node_name],
+            weight_percentage=round(
+                (node_name_to_weight[node_name] / max_weight) * 100, 2,
+            ),
+        )
+        for node_name in ordered_node_names
+    ]
+
+
+# Planning state kept across iterations - node_name_to_shards holds the shards
+# on each node that have not yet been moved, use get_node_shards to read them.
+State = namedtuple('State', (
+    'nodes',
+    'name_to_node',
+    'node_name_to_shards',
+    'sorted_node_names',
+    'index_to_node_names',
+    'node_name_to_order',
+    'min_heap',
+    'max_heap',
+    # Ids (index-shard) of moved shards, so no other copy of them is moved
+    'moved_shard_ids',
+))
+
+
+def _push_node(state, node):
+    # Ties are broken by the original node order, matching a stable sort
+    order = state.node_name_to_order[node['name']]
+    heapq.heappush(state.min_heap, (node['weight'], order, node['name']))
+    heapq.heappush(state.max_heap, (-node['weight'], -order, node['name']))
+
+
+def _peek_node(state, heap, sign):
+    # Entries are never removed when a node's weight changes, instead any that
+    # no longer match the node's current weight are dropped here.
+    while True:
+        weight, _, node_name = heap[0]
+        node = state.name_to_node[node_name]
+        if weight * sign == node['weight']:
+            return node
+        heapq.heappop(heap)
+
+
+def get_min_node(state):
+    return _peek_node(state, state.min_heap, 1)
+
+
+def get_max_node(state):
+    return _peek_node(state, state.max_heap, -1)
+
+
+def build_state(nodes, shards, node_names=None):
+    # If the nodes to swap between are already known only their shards matter
+    if node_names is not None:
+        shards = [shard for shard in shards if shard['node'] in node_names]
+
+    _, name_to_node, node_name_to_shards, index_to_node_names = (
+        combine_nodes_and_shards(nodes, shards)
+    )
+
+    state = State(
+        nodes=nodes,
+        name_to_node=name_to_node,
+        node_name_to_shards=node_name_to_shards,
+        sorted_node_names=set(),
+        index_to_node_names=index_to_node_names,
+        node_name_to_order={node['name']: i for i, node in enumerate(nodes)},
+        min_heap=[],
+        max_heap=[],
+        moved_shard_ids=set(),
+    )
+
+    for node in name_to_node.values():
+        _push_node(state, node)
+
+    return state
+
+
+def get_node_shards(state, node_name):
+    # Shards are sorted by weight (smallest first) the first time the node is
+    # used, as most nodes won't take part in any swaps on larger clusters.
+    shards = state.node_name_to_shards[node_name]
+
+    if node_name not in state.sorted_node_names:
+        shards.sort(key=itemgetter('weight'))
+        state.sorted_node_names.add(node_name)
+    return shards
+
+
+def _move_shard(state, shard, from_node, to_node):
+    weight = shard['weight']
+    shard['node'] = to_node['name']
+    from_node['weight'] -= weight
+    to_node['weight'] += weight
+    from_node['shard_count'] -= 1
+    to_node['shard_count'] += 1
+
+    node_names = state.index_to_node_names[shard['index']]
+    node_names[from_node['name']] -= 1
+    if not node_names[from_node['name']]:
+        del node_names[from_node['name']]
+    node_names[to_node['name']] += 1
+
+
+def update_state(state, moves):
+    updated_nodes = {}
 
-    for node in ordered_nodes:
-        node['weight_percentage'] = round((node['weight'] / max_weight) * 100, 2)
+    for shard, from_node, to_node in moves:
+        _move_shard(state, shard, from_node, to_node)
+        state.moved_shard_ids.add(shard['id'])
+        updated_nodes[from_node['name']] = from_node
+        updated_nodes[to_node['name']] = to_node
 
-    return ordered_nodes, node_name_to_shards, index_to_node_names
+    for node in updated_nodes.values():
+        _push_node(state, node)
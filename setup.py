@@ -2,7 +2,7 @@ from setuptools import setup
 
 REQUIREMENTS = (
     'click',
-    'humanize',
+    'orjson',
     'requests',
 )
 